@@ -1,27 +1,21 @@
 import streamlit as st
-import pandas as pd
-from datetime import datetime
-import pytz
-from PIL import Image
-import io
 import os
+import json
+import concurrent.futures
+import threading
 from dotenv import load_dotenv
-import openai
-from vision_utils import process_product_image
-from chatbot import get_chatbot_response
 from database import (
-    authenticate_user, add_product, 
-    get_user_inventory, update_inventory_quantity, get_low_stock_items, delete_product, get_product_usage_history
+    init_db, authenticate_user, upsert_product, clear_image_path,
+    get_user_inventory, update_inventory_quantity, bulk_update_inventory, get_low_stock_items, delete_product,
+    get_product_usage_history
 )
-import re
-import plotly.express as px
+
+# pandas, PIL, OpenAI, Google Cloud Vision and the modules built on them are
+# imported inside the functions that use them, so the login page loads fast
 
 # Load environment variables
 load_dotenv()
 
-# Initialize OpenAI
-openai.api_key = os.getenv("OPENAI_API_KEY")
-
 # Set page config
 st.set_page_config(
     page_title="Inventory Management System",
@@ -35,6 +29,155 @@ CATEGORIES = [
     'Dairy & Alternatives', 'Beverages', 'Frozen Foods', 'Bakery'
 ]
 
+# Units of measurement
+UNITS = ["kg", "g", "L", "ml", "pcs", "box", "pack"]
+
+# Inventory columns used by the pages
+_INV_COLS = ('product_name', 'category', 'quantity', 'unit', 'min_stock_level', 'date_added', 'last_used')
+
+# Largest size of stored product images
+IMAGE_MAX_SIZE = (1280, 1280)
+
+# Add product form fields and their values before any suggestion is applied
+ADD_FORM_DEFAULTS = {
+    'add_product_name': "",
+    'add_category': CATEGORIES[0],
+    'add_unit': UNITS[0],
+    'add_quantity': 1.0
+}
+
+# Seconds between checks for a finished image analysis
+ANALYSIS_POLL_INTERVAL = 1
+
+# Report prompts; several report types are requested together in one completion
+REPORT_TYPES = {
+    "Inventory Summary": {
+        "key": "inventory_summary",
+        "description": "A summary report of the inventory",
+        "instructions": "1. Total number of unique products\n2. Total inventory value\n3. Products with highest and lowest quantities\n4. Any products approaching their minimum stock level\n5. Recent inventory changes and trends"
+    },
+    "Low Stock Alert": {
+        "key": "low_stock",
+        "description": "An analysis of low stock items",
+        "instructions": "1. Products below their minimum stock level\n2. Products close to their minimum stock level\n3. Recommended reorder quantities\n4. Priority items that need immediate attention\n5. Usage patterns that might affect stock levels"
+    },
+    "Recent Activity": {
+        "key": "recent_activity",
+        "description": "An analysis of recent inventory changes",
+        "instructions": "1. Recently added products\n2. Products with significant quantity changes\n3. Any unusual patterns in inventory levels\n4. Recommendations for inventory management\n5. Usage trends and patterns"
+    },
+    "Custom Report": {
+        "key": "custom_report",
+        "description": "A comprehensive analysis of the inventory",
+        "instructions": "1. Overall inventory health assessment\n2. Key trends and patterns\n3. Risk areas and opportunities\n4. Specific recommendations for improvement\n5. Analysis of usage patterns and inventory changes"
+    }
+}
+
+# Report definitions come first and never change, so every report request
+# shares the same prompt prefix
+REPORT_SYSTEM_PROMPT = (
+    "You are an inventory management expert. Provide clear, actionable insights in a professional tone.\n"
+    "You write the reports requested by the user from their inventory data and recent usage history, "
+    "both given as CSV. The available reports are:\n\n"
+    + "\n\n".join(
+        f"{report['key']}: {report['description']}, including:\n{report['instructions']}"
+        for report in REPORT_TYPES.values()
+    )
+    + "\n\nRespond with a JSON object containing one key per requested report. "
+    "Each value is the report text in Markdown."
+)
+
+@st.cache_resource
+def init_database():
+    """Create or upgrade the database schema once per process"""
+    init_db()
+
+@st.cache_resource
+def get_openai_client():
+    """Create the OpenAI client once per process"""
+    from openai import AsyncOpenAI
+    # Retries are handled by openai_pool
+    return AsyncOpenAI(api_key=os.getenv("OPENAI_API_KEY"), max_retries=0)
+
+@st.cache_resource
+def get_system_prompt_template():
+    """Get the chatbot system prompt, without the parts that depend on inventory"""
+    return (
+        "You are a helpful inventory management assistant for a household and small business "
+        "inventory app. Answer questions about the user's inventory using the inventory data "
+        "they provide as CSV (product_name, category, quantity, unit, min_stock_level). "
+        "A product is low on stock when its quantity is at or below its min_stock_level. "
+        "Keep answers short and specific, and say so when the data does not answer the question. "
+        "Products are added on the 'Add Product' page, used on the 'Use Product' page, and "
+        "analyzed on the 'Reports' page.\n"
+        "Available categories: {categories}\n"
+        "Available units: {units}"
+    )
+
+@st.cache_resource
+def get_io_pool():
+    """Create the background thread pool for writing product images to disk"""
+    return concurrent.futures.ThreadPoolExecutor(max_workers=2)
+
+@st.cache_resource
+def get_vision_pool():
+    """Create the background thread pool for product image analysis"""
+    return concurrent.futures.ThreadPoolExecutor(max_workers=4)
+
+@st.cache_data(ttl=60)
+def cached_inventory(user_id, version):
+    """Get a user's inventory, cached until the inventory version changes"""
+    # Rows are converted to dicts so the result can be cached
+    return [dict(item) for item in get_user_inventory(user_id)]
+
+@st.cache_data(ttl=60)
+def inventory_derived(user_id, version):
+    """Get product lookups derived from a user's inventory, cached alongside it"""
+    inventory = cached_inventory(user_id, version)
+    by_name = {p['product_name']: p for p in inventory}
+    return {
+        'names': list(by_name),
+        'by_name': by_name,
+        # Reversed so the first product wins when names differ only in case
+        'by_lower_name': {p['product_name'].lower(): p for p in reversed(inventory)},
+        'categories': frozenset(p['category'] for p in inventory)
+    }
+
+@st.cache_data
+def category_options(existing_categories):
+    """Get the selectable categories, including custom ones already in use"""
+    return CATEGORIES + sorted(existing_categories.difference(CATEGORIES))
+
+def parse_timestamps(values):
+    """Parse timestamps stored by SQLite as Unix seconds"""
+    import pandas as pd
+
+    return pd.to_datetime(values, unit='s', utc=True)
+
+def history_frame(usage_history):
+    """Build a DataFrame straight from usage history rows"""
+    import pandas as pd
+    
+    if not usage_history:
+        return pd.DataFrame()
+    return pd.DataFrame.from_records(usage_history, columns=usage_history[0].keys())
+
+@st.cache_resource
+def get_inventory_versions():
+    """Create the per-user inventory version counters shared by every session"""
+    return {'lock': threading.Lock(), 'by_user': {}}
+
+def inventory_version(user_id):
+    """Get the current inventory version of a user, used as part of the cache key"""
+    return get_inventory_versions()['by_user'].get(user_id, 0)
+
+def bump_inventory_version():
+    """Invalidate cached inventory after a write, in every session of the user"""
+    versions = get_inventory_versions()
+    with versions['lock']:
+        user_id = st.session_state.user_id
+        versions['by_user'][user_id] = versions['by_user'].get(user_id, 0) + 1
+
 def initialize_session_state():
     """Initialize all session state variables"""
     if 'user_id' not in st.session_state:
@@ -43,9 +186,16 @@ def initialize_session_state():
         st.session_state.chat_history = []
     if 'current_page' not in st.session_state:
         st.session_state.current_page = "View Inventory"
+    if 'report_batch' not in st.session_state:
+        st.session_state.report_batch = None
+    if 'vision_analysis' not in st.session_state:
+        st.session_state.vision_analysis = None
+    if 'image_save' not in st.session_state:
+        st.session_state.image_save = None
 
 def main():
     """Main application function"""
+    init_database()
     initialize_session_state()
     
     st.title("🛒 Inventory Management System")
@@ -85,6 +235,7 @@ def show_main_interface():
     if st.sidebar.button("Logout"):
         st.session_state.user_id = None
         st.session_state.chat_history = []
+        st.session_state.report_batch = None
         st.rerun()
     
     # Display selected page
@@ -112,18 +263,18 @@ def show_use_product_page():
     """Display use product page with usage history"""
     st.header("Use Product")
     
-    inventory = get_user_inventory(st.session_state.user_id)
-    if inventory:
+    inventory = inventory_derived(st.session_state.user_id, inventory_version(st.session_state.user_id))
+    if inventory['names']:
         # Product selection and usage
         col1, col2 = st.columns(2)
         with col1:
             product_name = st.selectbox(
                 "Select Product",
-                [item['product_name'] for item in inventory]
+                inventory['names']
             )
             
             # Get current quantity
-            current_product = next((item for item in inventory if item['product_name'] == product_name), None)
+            current_product = inventory['by_name'].get(product_name)
             if current_product:
                 st.info(f"Current quantity: {current_product['quantity']} {current_product['unit']}")
             
@@ -137,6 +288,7 @@ def show_use_product_page():
                         st.error("Cannot use more than available quantity")
                     else:
                         if update_inventory_quantity(st.session_state.user_id, product_name, new_quantity):
+                            bump_inventory_version()
                             st.success(f"Updated {product_name} quantity to {new_quantity} {current_product['unit']}")
                             st.rerun()
                         else:
@@ -147,8 +299,8 @@ def show_use_product_page():
             st.subheader("Recent Usage History")
             usage_history = get_product_usage_history(st.session_state.user_id, product_name)
             if usage_history:
-                history_df = pd.DataFrame([dict(item) for item in usage_history])
-                history_df['usage_date'] = pd.to_datetime(history_df['usage_date']).dt.strftime('%Y-%m-%d %H:%M')
+                history_df = history_frame(usage_history)
+                history_df['usage_date'] = parse_timestamps(history_df['usage_date'])
                 st.dataframe(
                     history_df[['usage_date', 'quantity_used', 'operation_type']].rename(
                         columns={
@@ -157,7 +309,10 @@ def show_use_product_page():
                             'operation_type': 'Operation'
                         }
                     ),
-                    use_container_width=True
+                    use_container_width=True,
+                    column_config={
+                        "Date": st.column_config.DatetimeColumn("Date", format="YYYY-MM-DD HH:mm")
+                    }
                 )
             else:
                 st.info("No usage history available")
@@ -168,37 +323,87 @@ def show_use_product_page():
 
 def show_reports_page():
     """Display reports page"""
+    import pandas as pd
+    from openai_pool import run
+    
     st.header("Inventory Reports")
     
-    report_type = st.selectbox(
-        "Select Report Type",
-        ["Inventory Summary", "Low Stock Alert", "Recent Activity", "Custom Report"]
+    report_types = st.multiselect(
+        "Select Report Types",
+        list(REPORT_TYPES),
+        default=["Inventory Summary"]
     )
     
-    if st.button("Generate Report"):
-        inventory = get_user_inventory(st.session_state.user_id)
+    col1, col2 = st.columns(2)
+    with col1:
+        generate = st.button("Generate Report")
+    with col2:
+        submit_batch = st.button(
+            "Submit as Batch",
+            help="Processed by the OpenAI Batch API within 24 hours at half the cost"
+        )
+    
+    if (generate or submit_batch) and not report_types:
+        st.warning("Please select at least one report type")
+    elif generate or submit_batch:
+        inventory = cached_inventory(st.session_state.user_id, inventory_version(st.session_state.user_id))
         if inventory:
-            inventory_df = pd.DataFrame([dict(item) for item in inventory])
-            report = generate_inventory_report(inventory_df, report_type)
-            st.markdown(report)
+            inventory_df = pd.DataFrame.from_records(inventory, columns=_INV_COLS)
+            history_df = history_frame(get_product_usage_history(st.session_state.user_id))
+            if generate:
+                with st.spinner("Generating report..."):
+                    report = run(generate_inventory_report(get_openai_client(), inventory_df, history_df, report_types))
+                st.markdown(report)
+            else:
+                try:
+                    batch_id = run(submit_report_batch(get_openai_client(), inventory_df, history_df, report_types))
+                    st.session_state.report_batch = {
+                        'id': batch_id,
+                        'report_types': report_types,
+                        'report': None
+                    }
+                except Exception as e:
+                    st.error(f"Error submitting batch: {str(e)}")
         else:
             st.info("No inventory data available for report generation")
     
+    # Batch report status
+    report_batch = st.session_state.report_batch
+    if report_batch:
+        st.subheader(f"Batch Report: {', '.join(report_batch['report_types'])}")
+        if report_batch['report'] is None and st.button("Check Status"):
+            try:
+                status, report = run(fetch_report_batch(get_openai_client(), report_batch['id'], report_batch['report_types']))
+                if report is not None:
+                    report_batch['report'] = report
+                elif status in ("failed", "expired", "cancelled"):
+                    st.error(f"Batch {status}")
+                else:
+                    st.info(f"Batch status: {status}")
+            except Exception as e:
+                st.error(f"Error checking batch: {str(e)}")
+        if report_batch['report'] is not None:
+            st.markdown(report_batch['report'])
+        else:
+            st.caption(f"Batch ID: {report_batch['id']}")
+    
     display_chatbot()
 
 def display_inventory_table(user_id):
     """Display inventory in a table format with filters and delete option"""
-    inventory = get_user_inventory(user_id)
+    import pandas as pd
+    
+    inventory = cached_inventory(user_id, inventory_version(user_id))
     if not inventory:
         st.info("No items in inventory")
         return
     
     # Convert to DataFrame for easier filtering
-    df = pd.DataFrame([dict(item) for item in inventory])
+    df = pd.DataFrame.from_records(inventory, columns=_INV_COLS)
     
-    # Format date columns to DD-MM-YY HH:mm
-    df['date_added'] = pd.to_datetime(df['date_added']).dt.strftime('%d-%m-%y %H:%M')
-    df['last_used'] = pd.to_datetime(df['last_used']).dt.strftime('%d-%m-%y %H:%M')
+    # Parse date columns; they are formatted as DD-MM-YY HH:mm by the table
+    df['date_added'] = parse_timestamps(df['date_added'])
+    df['last_used'] = parse_timestamps(df['last_used'])
     
     # Add filters
     col1, col2 = st.columns(2)
@@ -285,17 +490,16 @@ def display_inventory_table(user_id):
             # Convert edited DataFrame back to original format
             edited_df = edited_df.rename(columns={v: k for k, v in display_columns.items()})
             
-            # Update each product in the database
-            for _, row in edited_df.iterrows():
-                update_inventory_quantity(
-                    user_id,
-                    row['product_name'],
-                    row['quantity'],
-                    row['min_stock_level']
-                )
-            
-            st.success("Inventory updated successfully!")
-            st.rerun()
+            # Update all products in a single transaction
+            if bulk_update_inventory(
+                user_id,
+                edited_df[['product_name', 'quantity', 'min_stock_level']].to_dict('records')
+            ):
+                bump_inventory_version()
+                st.success("Inventory updated successfully!")
+                st.rerun()
+            else:
+                st.error("Failed to update inventory")
         except Exception as e:
             st.error(f"Error updating inventory: {str(e)}")
     
@@ -308,28 +512,27 @@ def display_inventory_table(user_id):
     
     if product_to_delete and st.button("Delete Product"):
         if delete_product(user_id, product_to_delete):
+            bump_inventory_version()
             st.success(f"Product '{product_to_delete}' deleted successfully!")
             st.rerun()
         else:
             st.error("Failed to delete product")
 
+@st.fragment
 def display_chatbot():
-    """Display the chatbot interface"""
+    """Display the chatbot interface, rerunning on its own when the user chats"""
+    import pandas as pd
+    from openai_pool import iterate
+    from chatbot import stream_chatbot_response
+    
     st.subheader("Inventory Assistant")
     
     # Get current inventory data
     if st.session_state.user_id:
-        inventory = get_user_inventory(st.session_state.user_id)
+        inventory = cached_inventory(st.session_state.user_id, inventory_version(st.session_state.user_id))
         if inventory:
             # Convert inventory to DataFrame
-            inventory_df = pd.DataFrame([dict(item) for item in inventory])
-            # Rename columns to match expected format
-            inventory_df = inventory_df.rename(columns={
-                'product_name': 'product_name',
-                'quantity': 'quantity',
-                'unit': 'unit',
-                'category': 'category'
-            })
+            inventory_df = pd.DataFrame.from_records(inventory, columns=_INV_COLS)
         else:
             inventory_df = pd.DataFrame()
     else:
@@ -338,126 +541,228 @@ def display_chatbot():
     # Chat interface
     user_input = st.text_input("Ask me anything about your inventory:")
     if user_input:
-        response = get_chatbot_response(user_input, inventory_df)
-        st.write("Assistant:", response)
+        system_prompt = get_system_prompt_template().format(
+            categories=', '.join(CATEGORIES),
+            units=', '.join(UNITS)
+        )
+        st.write("Assistant:")
+        st.write_stream(iterate(
+            stream_chatbot_response(user_input, inventory_df, get_openai_client(), system_prompt)
+        ))
+
+def build_report_request(inventory_df, history_df, report_types):
+    """Build a single chat completion request covering all selected report types"""
+    from chatbot import get_inventory_csv, get_history_csv
+    
+    # Prepare compact data for OpenAI
+    inventory_summary = get_inventory_csv(inventory_df)
+    history_summary = get_history_csv(history_df)
+    
+    keys = ", ".join(REPORT_TYPES[report_type]['key'] for report_type in report_types)
+    prompt = f"""Write these reports: {keys}
+
+Inventory data:
+{inventory_summary}
+
+Recent usage history:
+{history_summary}"""
+    
+    return {
+        "model": "gpt-3.5-turbo",
+        "messages": [
+            {"role": "system", "content": REPORT_SYSTEM_PROMPT},
+            {"role": "user", "content": prompt}
+        ],
+        "response_format": {"type": "json_object"},
+        "temperature": 0.7,
+        "max_tokens": 500 * len(report_types)
+    }
+
+def report_markdown(value, indent=""):
+    """Render a report value from the JSON response, which may be nested, as Markdown"""
+    if isinstance(value, dict):
+        items = [(f"**{key}**: ", item) for key, item in value.items()]
+    elif isinstance(value, list):
+        items = [("", item) for item in value]
+    else:
+        return str(value)
 
-def generate_inventory_report(inventory_df, report_type):
+    # Nested objects and arrays become indented bullet lists
+    lines = []
+    for label, item in items:
+        if isinstance(item, (dict, list)):
+            lines.append(f"{indent}- {label}".rstrip())
+            lines.append(report_markdown(item, indent + "  "))
+        else:
+            lines.append(f"{indent}- {label}{item}")
+    return "\n".join(lines)
+
+def render_reports(content, report_types):
+    """Render the JSON returned for a report request as Markdown sections"""
+    try:
+        reports = json.loads(content)
+    except json.JSONDecodeError:
+        return "Error generating report: the response was not valid JSON."
+    if not isinstance(reports, dict):
+        return "Error generating report: the response was not a JSON object."
+
+    parts = []
+    for report_type in report_types:
+        report = reports.get(REPORT_TYPES[report_type]['key'])
+        report = report_markdown(report) if report else "This report could not be generated."
+        parts.append(f"### {report_type}\n\n{report}")
+    return "\n\n".join(parts)
+
+async def generate_inventory_report(client, inventory_df, history_df, report_types):
     """Generate user-friendly inventory reports with insights"""
+    from openai_pool import chat_completion
+    
     try:
         if inventory_df.empty:
             return "No inventory data available for report generation."
         
-        # Get usage history for the report
-        usage_history = get_product_usage_history(st.session_state.user_id)
-        history_df = pd.DataFrame([dict(item) for item in usage_history])
-        
-        # Prepare data for OpenAI
-        inventory_summary = inventory_df.to_dict('records')
-        history_summary = history_df.to_dict('records')
-        
-        # Create a prompt based on the report type
-        if report_type == "Inventory Summary":
-            prompt = f"""
-            Generate a summary report for the following inventory data:
-            {inventory_summary}
-            
-            Recent usage history:
-            {history_summary}
-            
-            Please provide:
-            1. Total number of unique products
-            2. Total inventory value
-            3. Products with highest and lowest quantities
-            4. Any products approaching their minimum stock level
-            5. Recent inventory changes and trends
-            """
-        elif report_type == "Low Stock Alert":
-            prompt = f"""
-            Analyze the following inventory data for low stock items:
-            {inventory_summary}
-            
-            Recent usage history:
-            {history_summary}
-            
-            Please identify:
-            1. Products below their minimum stock level
-            2. Products close to their minimum stock level
-            3. Recommended reorder quantities
-            4. Priority items that need immediate attention
-            5. Usage patterns that might affect stock levels
-            """
-        elif report_type == "Recent Activity":
-            prompt = f"""
-            Analyze the following inventory data for recent changes:
-            {inventory_summary}
-            
-            Recent usage history:
-            {history_summary}
-            
-            Please provide:
-            1. Recently added products
-            2. Products with significant quantity changes
-            3. Any unusual patterns in inventory levels
-            4. Recommendations for inventory management
-            5. Usage trends and patterns
-            """
-        else:  # Custom Report
-            prompt = f"""
-            Provide a comprehensive analysis of the following inventory data:
-            {inventory_summary}
-            
-            Recent usage history:
-            {history_summary}
-            
-            Please include:
-            1. Overall inventory health assessment
-            2. Key trends and patterns
-            3. Risk areas and opportunities
-            4. Specific recommendations for improvement
-            5. Analysis of usage patterns and inventory changes
-            """
-        
-        try:
-            response = openai.ChatCompletion.create(
-                model="gpt-3.5-turbo",
-                messages=[
-                    {"role": "system", "content": "You are an inventory management expert. Provide clear, actionable insights in a professional tone."},
-                    {"role": "user", "content": prompt}
-                ],
-                temperature=0.7,
-                max_tokens=500
-            )
-            return response.choices[0].message.content
-        except Exception as e:
-            return f"Error with OpenAI API: {str(e)}"
+        # All selected reports share one request, so the data is only sent once
+        response = await chat_completion(client, **build_report_request(inventory_df, history_df, report_types))
+        return render_reports(response.choices[0].message.content, report_types)
             
     except Exception as e:
         return f"Error generating report: {str(e)}. Please check your OpenAI API key and internet connection."
 
+async def submit_report_batch(client, inventory_df, history_df, report_types):
+    """Submit the report request to the OpenAI Batch API and return the batch ID"""
+    line = json.dumps({
+        "custom_id": "report",
+        "method": "POST",
+        "url": "/v1/chat/completions",
+        "body": build_report_request(inventory_df, history_df, report_types)
+    })
+    batch_file = await client.files.create(
+        file=("report.jsonl", line.encode("utf-8")),
+        purpose="batch"
+    )
+    batch = await client.batches.create(
+        input_file_id=batch_file.id,
+        endpoint="/v1/chat/completions",
+        completion_window="24h"
+    )
+    return batch.id
+
+async def fetch_report_batch(client, batch_id, report_types):
+    """Get the status of a report batch and the report once it has completed"""
+    batch = await client.batches.retrieve(batch_id)
+    if batch.status != "completed":
+        return batch.status, None
+    if not batch.output_file_id:
+        return batch.status, "This report could not be generated."
+    
+    output = await client.files.content(batch.output_file_id)
+    result = json.loads(output.text.splitlines()[0])
+    if result.get("response") and result["response"]["status_code"] == 200:
+        content = result["response"]["body"]["choices"][0]["message"]["content"]
+        return batch.status, render_reports(content, report_types)
+    return batch.status, "This report could not be generated."
+
+def save_product_image(image, image_path):
+    """Downscale a product image and save it as JPEG"""
+    from PIL import Image
+    
+    # JPEG has no alpha channel; convert also leaves the displayed image untouched
+    image = image.convert("RGB")
+    image.thumbnail(IMAGE_MAX_SIZE, Image.Resampling.LANCZOS)
+    image.save(image_path, "JPEG", quality=85, optimize=True)
+
+def forget_failed_image(user_id, product_name, category, image_path):
+    """Build a callback that drops a product's image path if the background save failed"""
+    def callback(future):
+        if future.exception():
+            print(f"Error saving image: {str(future.exception())}")
+            clear_image_path(user_id, product_name, category, image_path)
+    return callback
+
+@st.fragment(run_every=ANALYSIS_POLL_INTERVAL)
+def poll_vision_analysis(analysis_future):
+    """Rerun the page once a background image analysis has finished"""
+    if analysis_future.done():
+        st.rerun()
+    st.info("Analyzing image...")
+
+def apply_suggestions(suggestions, all_categories):
+    """Fill add product form fields the user has not edited with suggested values"""
+    for key, value in suggestions.items():
+        if key == 'add_category' and value not in all_categories:
+            continue
+        if key == 'add_unit' and value not in UNITS:
+            continue
+        if st.session_state[key] == ADD_FORM_DEFAULTS[key]:
+            st.session_state[key] = value
+
 def get_inventory_data():
     """Get inventory data for the current user"""
+    import pandas as pd
+    
     if 'user_id' not in st.session_state:
         return pd.DataFrame()
-    inventory = get_user_inventory(st.session_state.user_id)
+    inventory = cached_inventory(st.session_state.user_id, inventory_version(st.session_state.user_id))
     if not inventory:
         return pd.DataFrame()
-    return pd.DataFrame(inventory)
+    return pd.DataFrame.from_records(inventory, columns=_INV_COLS)
 
 def add_product_ui(user_id):
     """UI for adding new products with smart suggestions"""
-    st.header("Add New Product")
+    import time
+    from PIL import Image
+    from vision_utils import process_product_image
     
+    st.header("Add New Product")
+
+    # Report the last image save once it has finished
+    image_save = st.session_state.image_save
+    if image_save is not None and image_save.done():
+        if image_save.exception():
+            st.error(f"Could not save the product image, so the product was stored without it: {str(image_save.exception())}")
+        st.session_state.image_save = None
+
+    # Get existing products for suggestions
+    inventory = inventory_derived(user_id, inventory_version(user_id))
+
+    # Get all unique categories from existing products
+    all_categories = category_options(inventory['categories'])
+
+    # Form values live in session state so suggestions never replace user input
+    for key, value in ADD_FORM_DEFAULTS.items():
+        if key not in st.session_state:
+            st.session_state[key] = value
+
     col1, col2 = st.columns(2)
-    
+
     with col1:
         uploaded_image = st.file_uploader("Upload Product Image", type=["jpg", "jpeg", "png"])
-        if uploaded_image is not None:
+        analysis_future = None
+        if uploaded_image is None:
+            st.session_state.vision_analysis = None
+        else:
             image = Image.open(uploaded_image)
             st.image(image, caption="Uploaded Image", use_container_width=True)
             
-            # Process image with Google Cloud Vision and OpenAI
+            # Process image with Google Cloud Vision and OpenAI in the background,
+            # once per uploaded file, so the form renders without waiting for it
+            vision_analysis = st.session_state.vision_analysis
+            if vision_analysis is None or vision_analysis['file_id'] != uploaded_image.file_id:
+                vision_analysis = {
+                    'file_id': uploaded_image.file_id,
+                    'future': get_vision_pool().submit(process_product_image, image, uploaded_image.getvalue()),
+                    'applied': False
+                }
+                st.session_state.vision_analysis = vision_analysis
+            analysis_future = vision_analysis['future']
+
+            # Check back periodically instead of blocking, so the form stays responsive
+            if not analysis_future.done():
+                poll_vision_analysis(analysis_future)
+
+        if analysis_future is not None and analysis_future.done():
             try:
-                analysis_results = process_product_image(image)
+                analysis_results = analysis_future.result()
                 enhanced_results = analysis_results['enhanced_results']
                 
                 # Display enhanced analysis
@@ -469,51 +774,39 @@ def add_product_ui(user_id):
                     st.write(f"Suggested Quantity: {enhanced_results['quantity']}")
                     if enhanced_results['notes']:
                         st.write(f"Notes: {enhanced_results['notes']}")
-                    
-                    # Set default values for the form
-                    suggested_name = enhanced_results['product_name']
-                    suggested_category = enhanced_results['category']
-                    suggested_unit = enhanced_results['unit']
-                    suggested_quantity = enhanced_results['quantity']
+
+                    # Fill in the form once per image, before its widgets are created
+                    if not vision_analysis['applied']:
+                        apply_suggestions({
+                            'add_product_name': enhanced_results['product_name'],
+                            'add_category': enhanced_results['category'],
+                            'add_unit': enhanced_results['unit'],
+                            'add_quantity': float(enhanced_results['quantity'])
+                        }, all_categories)
+                        vision_analysis['applied'] = True
                 else:
                     st.warning("Could not analyze the image")
-                    suggested_name = ""
-                    suggested_category = "Grocery"
-                    suggested_unit = "pcs"
-                    suggested_quantity = 1.0
             except Exception as e:
                 st.error(f"Error processing image: {str(e)}")
-                suggested_name = ""
-                suggested_category = "Grocery"
-                suggested_unit = "pcs"
-                suggested_quantity = 1.0
-    
+
     with col2:
-        # Get existing products for suggestions
-        existing_products = get_user_inventory(user_id)
-        existing_names = [p['product_name'] for p in existing_products] if existing_products else []
-        
         # Product name input with autocomplete
-        product_name = st.text_input("Product Name", value=suggested_name if 'suggested_name' in locals() else "")
-        
-        # Get all unique categories from existing products
-        existing_categories = list(set(p['category'] for p in existing_products))
-        all_categories = list(set(CATEGORIES + existing_categories))
-        
+        product_name = st.text_input("Product Name", key='add_product_name')
+
         # If product exists, show its details but allow changes
-        matching_products = [p for p in existing_products if p['product_name'].lower() == product_name.lower()]
-        if matching_products:
-            existing_product = matching_products[0]
+        existing_product = inventory['by_lower_name'].get(product_name.lower())
+        if existing_product:
             st.info(f"Product already exists:")
             st.write(f"Current Category: {existing_product['category']}")
             st.write(f"Current Unit: {existing_product['unit']}")
             st.write(f"Current Quantity: {existing_product['quantity']}")
             
-            # Allow changing category and unit
-            category = st.selectbox("Category", all_categories, 
-                                  index=all_categories.index(existing_product['category']) if existing_product['category'] in all_categories else 0)
-            unit = st.selectbox("Unit", ["kg", "g", "L", "ml", "pcs", "box", "pack"],
-                              index=["kg", "g", "L", "ml", "pcs", "box", "pack"].index(existing_product['unit']) if existing_product['unit'] in ["kg", "g", "L", "ml", "pcs", "box", "pack"] else 0)
+            # Allow changing the unit; the category is part of the product's key,
+            # so it is shown read-only
+            category = existing_product['category']
+            st.selectbox("Category", [category], disabled=True)
+            unit = st.selectbox("Unit", UNITS,
+                              index=UNITS.index(existing_product['unit']) if existing_product['unit'] in UNITS else 0)
             
             # Show current quantity and allow updating
             current_quantity = st.number_input("Current Quantity", min_value=0.0, step=0.1, value=existing_product['quantity'])
@@ -521,34 +814,54 @@ def add_product_ui(user_id):
             new_quantity = current_quantity + quantity_change
         else:
             # New product inputs with suggested values
-            category = st.selectbox("Category", all_categories, 
-                                  index=all_categories.index(suggested_category) if 'suggested_category' in locals() and suggested_category in all_categories else 0)
-            unit = st.selectbox("Unit", ["kg", "g", "L", "ml", "pcs", "box", "pack"],
-                              index=["kg", "g", "L", "ml", "pcs", "box", "pack"].index(suggested_unit) if 'suggested_unit' in locals() and suggested_unit in ["kg", "g", "L", "ml", "pcs", "box", "pack"] else 0)
-            new_quantity = st.number_input("Quantity", min_value=0.0, step=0.1, value=suggested_quantity if 'suggested_quantity' in locals() else 1.0)
+            if st.session_state.add_category not in all_categories:
+                st.session_state.add_category = ADD_FORM_DEFAULTS['add_category']
+            category = st.selectbox("Category", all_categories, key='add_category')
+            unit = st.selectbox("Unit", UNITS, key='add_unit')
+            new_quantity = st.number_input("Quantity", min_value=0.0, step=0.1, key='add_quantity')
     
     if st.button("Add/Update Product"):
         if product_name:
+            image_path = None
+            image_save = None
             if uploaded_image:
                 # Save image
-                current_time = datetime.now(pytz.UTC)
-                image_path = f"images/{product_name}_{current_time.timestamp()}.jpg"
+                image_path = f"images/{product_name}_{time.time()}.jpg"
                 os.makedirs("images", exist_ok=True)
-                image.save(image_path)
-            else:
-                image_path = None
+                # Encode and write in the background; the path is stored right away
+                image_save = get_io_pool().submit(save_product_image, image, image_path)
+                try:
+                    image_save.result(timeout=0.05)
+                except concurrent.futures.TimeoutError:
+                    pass
+                except Exception:
+                    # Failed already, so the product is stored without an image
+                    image_path = None
             
-            # Add or update product
-            if matching_products:
-                # Update existing product
-                if update_inventory_quantity(user_id, product_name, new_quantity):
-                    st.success(f"Updated {product_name} quantity to {new_quantity} {unit}")
-                else:
-                    st.error("Failed to update product")
+            # Add or update product with a single upsert
+            if existing_product:
+                # Update the stored product, which may differ in case from the typed name
+                stored_name, stored_category = existing_product['product_name'], existing_product['category']
+                saved = upsert_product(user_id, stored_name, stored_category,
+                                       unit, new_quantity, mode='set', image_path=image_path)
+                message = f"Updated {existing_product['product_name']} quantity to {new_quantity} {unit}"
             else:
                 # Add new product
-                add_product(user_id, product_name, category, new_quantity, unit, image_path, min_stock_level=0)
-                st.success(f"Product {product_name} added successfully!")
+                stored_name, stored_category = product_name, category
+                saved = upsert_product(user_id, stored_name, stored_category, unit, new_quantity,
+                                       mode='add', image_path=image_path)
+                message = f"Product {product_name} added successfully!"
+            
+            if saved:
+                bump_inventory_version()
+                st.success(message)
+                if image_path:
+                    # A save that fails later must not leave the stored path dangling
+                    image_save.add_done_callback(forget_failed_image(user_id, stored_name, stored_category, image_path))
+                # Checked on the next run, which reports a failed save
+                st.session_state.image_save = image_save
+            else:
+                st.error("Failed to save product")
             
             # Update categories list if new category was added
             if category not in CATEGORIES:
@@ -1,68 +1,112 @@
 import os
-import openai
+import re
+import time
 from dotenv import load_dotenv
+from openai_pool import chat_completion_stream
 import pandas as pd
-from datetime import datetime, timedelta
 from database import add_product, update_inventory_quantity, get_user_inventory
 
 # Load environment variables
 load_dotenv()
 
-# Initialize OpenAI
-openai.api_key = os.getenv("OPENAI_API_KEY")
-if not openai.api_key:
+# Check OpenAI configuration
+if not os.getenv("OPENAI_API_KEY"):
     raise ValueError("OPENAI_API_KEY environment variable is not set")
 
+# Columns and size limits for the data sent in prompts
+INVENTORY_PROMPT_COLUMNS = ['product_name', 'category', 'quantity', 'unit', 'min_stock_level']
+HISTORY_PROMPT_COLUMNS = ['usage_date', 'product_name', 'quantity_used', 'operation_type']
+MAX_CONTEXT_CHARS = 4000
+HISTORY_DAYS = 30
+
+# Keywords that route a message to a built-in reply instead of OpenAI
+ADD_COMMAND_RE = re.compile(r'\badd\b', re.IGNORECASE)
+USE_COMMAND_RE = re.compile(r'\buse\b', re.IGNORECASE)
+STATUS_COMMAND_RE = re.compile(r'\b(?:status|check)\b', re.IGNORECASE)
+
 def get_inventory_context(inventory_df):
     """Generate context string from inventory DataFrame"""
     if inventory_df.empty:
         return "The inventory is currently empty."
     
-    context = "Current inventory status:\n"
-    for _, row in inventory_df.iterrows():
-        context += f"- {row['product_name']}: {row['quantity']} {row['unit']} (Category: {row['category']})\n"
-    return context
+    # Build all lines with column operations instead of iterating rows
+    lines = (
+        "- " + inventory_df['product_name'].astype(str)
+        + ": " + inventory_df['quantity'].astype(str)
+        + " " + inventory_df['unit'].astype(str)
+        + " (Category: " + inventory_df['category'].astype(str) + ")"
+    )
+    return "Current inventory status:\n" + "\n".join(lines.tolist()) + "\n"
+
+def get_inventory_csv(inventory_df):
+    """Serialize inventory as compact CSV for prompts, truncating large inventories"""
+    if inventory_df.empty:
+        return "The inventory is currently empty."
+    
+    df = inventory_df[INVENTORY_PROMPT_COLUMNS]
+    context = df.to_csv(index=False)
+    if len(context) <= MAX_CONTEXT_CHARS:
+        return context
+    
+    # Keep only low stock items and the 20 largest quantities
+    low_stock = df[df['quantity'] <= df['min_stock_level']]
+    largest = df.nlargest(20, 'quantity')
+    truncated = df.loc[low_stock.index.union(largest.index)]
+    return (
+        f"Showing {len(truncated)} of {len(df)} products (low stock and largest quantities):\n"
+        + truncated.to_csv(index=False)
+    )
+
+def get_history_csv(history_df, days=HISTORY_DAYS):
+    """Serialize recent usage history as compact CSV for prompts"""
+    if history_df.empty:
+        return "No recent usage history."
+    
+    # Dates are Unix seconds, so the cutoff is a plain number comparison
+    cutoff = time.time() - days * 24 * 60 * 60
+    recent = history_df[history_df['usage_date'] > cutoff]
+    if recent.empty:
+        return "No recent usage history."
+    # Readable dates for the model; minutes are precise enough
+    usage_dates = pd.to_datetime(recent['usage_date'], unit='s', utc=True).dt.strftime('%Y-%m-%d %H:%M')
+    return recent.assign(usage_date=usage_dates)[HISTORY_PROMPT_COLUMNS].to_csv(index=False)
 
 def process_inventory_command(command, inventory_df):
     """Process inventory-related commands"""
-    if "add" in command.lower():
+    if ADD_COMMAND_RE.search(command):
         return "To add items to inventory, please use the 'Add Inventory' page."
-    elif "use" in command.lower():
+    elif USE_COMMAND_RE.search(command):
         return "To use items from inventory, please use the 'Use Inventory' page."
-    elif "status" in command.lower() or "check" in command.lower():
+    elif STATUS_COMMAND_RE.search(command):
         return get_inventory_context(inventory_df)
     return None
 
-def get_chatbot_response(user_input, inventory_df):
-    """Get response from OpenAI chatbot with inventory context"""
+async def stream_chatbot_response(user_input, inventory_df, client, system_prompt):
+    """Stream response from OpenAI chatbot with inventory context"""
     try:
         # Process inventory-specific commands first
         inventory_response = process_inventory_command(user_input, inventory_df)
         if inventory_response:
-            return inventory_response
+            yield inventory_response
+            return
 
         # Get inventory context
-        inventory_context = get_inventory_context(inventory_df)
+        inventory_context = get_inventory_csv(inventory_df)
         
-        # Prepare the prompt with inventory context
-        prompt = f"""You are an inventory management assistant. Here is the current inventory status:
-{inventory_context}
-
-User: {user_input}
-Assistant:"""
-
-        # Call OpenAI API using the old format
-        response = openai.ChatCompletion.create(
+        # Call OpenAI API
+        async for text in chat_completion_stream(
+            client,
             model="gpt-3.5-turbo",
             messages=[
-                {"role": "system", "content": "You are a helpful inventory management assistant."},
-                {"role": "user", "content": prompt}
+                # Stable instructions first, so requests share a cacheable prefix
+                {"role": "system", "content": system_prompt},
+                {"role": "user", "content": f"Current inventory:\n{inventory_context}"},
+                {"role": "user", "content": user_input}
             ],
             max_tokens=150,
             temperature=0.7
-        )
-        
-        return response.choices[0].message.content.strip()
+        ):
+            yield text
     
     except Exception as e:
-        return f"Error getting chatbot response: {str(e)}" 
\ No newline at end of file
+        yield f"Error getting chatbot response: {str(e)}"
@@ -1,7 +1,9 @@
 import sqlite3
 import os
-from datetime import datetime
-import pytz
+import atexit
+import threading
+import time
+from contextlib import contextmanager
 from dotenv import load_dotenv
 
 # Load environment variables
@@ -14,17 +16,275 @@ PREDEFINED_USERS = {
     os.getenv('USER2_USERNAME', 'user2'): os.getenv('USER2_PASSWORD', 'user123')
 }
 
+DB_PATH = 'inventory.db'
+
+# Stored in PRAGMA user_version once the schema below has been created
+SCHEMA_VERSION = 5
+
+# WAL lets readers run alongside a writer and, with synchronous=NORMAL, only
+# syncs at checkpoints; the other settings apply to each connection
+CONNECTION_PRAGMAS = '''
+    PRAGMA journal_mode = WAL;
+    PRAGMA synchronous = NORMAL;
+    PRAGMA temp_store = MEMORY;
+    PRAGMA cache_size = -20000;
+    PRAGMA mmap_size = 268435456;
+    PRAGMA foreign_keys = ON;
+'''
+
+# Statements kept compiled per connection; well above the number used here
+STATEMENT_CACHE_SIZE = 256
+
+# Statements run on every page load or product change
+SQL_GET_USER_ID = 'SELECT id FROM users WHERE username = ?'
+
+# Inventory columns shown in the app; image_path is only ever written
+INVENTORY_COLUMNS = 'product_name, category, quantity, unit, min_stock_level, date_added, last_used'
+
+SQL_GET_INVENTORY = f'SELECT {INVENTORY_COLUMNS} FROM inventory WHERE user_id = ?'
+
+SQL_GET_LOW_STOCK = f'''
+    SELECT {INVENTORY_COLUMNS} FROM inventory 
+    WHERE user_id = ? AND quantity <= min_stock_level
+'''
+
+SQL_INSERT_HISTORY = '''
+    INSERT INTO product_usage_history
+    (user_id, product_name, category, quantity_used, usage_date, operation_type)
+    VALUES (?, ?, ?, ?, ?, ?)
+'''
+
+HISTORY_COLUMNS = 'id, product_name, category, quantity_used, usage_date, operation_type'
+
+SQL_GET_HISTORY = f'''
+    SELECT {HISTORY_COLUMNS}
+    FROM product_usage_history
+    WHERE user_id = ?
+    ORDER BY usage_date DESC, id DESC
+    LIMIT ?
+'''
+
+SQL_GET_PRODUCT_HISTORY = f'''
+    SELECT {HISTORY_COLUMNS}
+    FROM product_usage_history
+    WHERE user_id = ? AND product_name = ?
+    ORDER BY usage_date DESC, id DESC
+    LIMIT ?
+'''
+
+# Inventory is keyed on user, name and category rather than a rowid, since
+# every lookup filters on them; history rows follow renames and deletes.
+# Timestamps are stored as integer Unix seconds in UTC
+SQL_CREATE_INVENTORY = '''
+    CREATE TABLE IF NOT EXISTS {table} (
+        user_id INTEGER NOT NULL,
+        product_name TEXT NOT NULL,
+        category TEXT NOT NULL,
+        quantity REAL NOT NULL,
+        unit TEXT NOT NULL,
+        date_added INTEGER DEFAULT (CAST(strftime('%s', 'now') AS INTEGER)),
+        last_used INTEGER,
+        image_path TEXT,
+        min_stock_level REAL,
+        PRIMARY KEY (user_id, product_name, category),
+        FOREIGN KEY (user_id) REFERENCES users (id)
+    ) WITHOUT ROWID
+'''
+
+SQL_CREATE_HISTORY = '''
+    CREATE TABLE IF NOT EXISTS {table} (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        user_id INTEGER NOT NULL,
+        product_name TEXT NOT NULL,
+        category TEXT NOT NULL,
+        quantity_used REAL NOT NULL,
+        usage_date INTEGER DEFAULT (CAST(strftime('%s', 'now') AS INTEGER)),
+        operation_type TEXT NOT NULL,  -- 'add' or 'remove'
+        FOREIGN KEY (user_id) REFERENCES users (id),
+        FOREIGN KEY (user_id, product_name, category)
+            REFERENCES inventory (user_id, product_name, category)
+            ON DELETE CASCADE ON UPDATE CASCADE
+    )
+'''
+
+# Each thread keeps one connection open for the life of the process
+_local = threading.local()
+_connections = {}
+_connections_lock = threading.Lock()
+_init_lock = threading.Lock()
+
+# History rows written between background refreshes of the planner statistics
+ANALYZE_EVERY = 500
+_history_writes = 0
+_history_writes_lock = threading.Lock()
+
+# User IDs by username; users are never renamed or deleted, so this never goes stale
+_user_ids = {}
+
 def get_db_connection():
-    """Create a connection to the SQLite database."""
-    conn = sqlite3.connect('inventory.db')
-    conn.row_factory = sqlite3.Row
+    """Get this thread's connection to the SQLite database, opening it on first use."""
+    conn = getattr(_local, 'conn', None)
+    if conn is None:
+        # Autocommit mode; writes that belong together use transaction()
+        conn = sqlite3.connect(DB_PATH, check_same_thread=False, isolation_level=None,
+                               cached_statements=STATEMENT_CACHE_SIZE)
+        conn.row_factory = sqlite3.Row
+        conn.executescript(CONNECTION_PRAGMAS)
+        _local.conn = conn
+        with _connections_lock:
+            _connections[threading.current_thread()] = conn
+            # Close connections left behind by threads that have finished;
+            # no PRAGMA optimize here, as it could fail or stall this request
+            for thread in [t for t in _connections if not t.is_alive()]:
+                _connections.pop(thread).close()
     return conn
 
+def _close_connection(conn):
+    """Let SQLite refresh any statistics its queries found stale, then close the connection."""
+    try:
+        conn.execute('PRAGMA optimize')
+    except Exception as e:
+        print(f"Error optimizing database: {str(e)}")
+    finally:
+        conn.close()
+
+def close_db_connections():
+    """Close every open connection to the SQLite database, optimizing it on the way out."""
+    with _connections_lock:
+        for conn in _connections.values():
+            _close_connection(conn)
+        _connections.clear()
+
+atexit.register(close_db_connections)
+
+def fetch_tuples(sql, params=()):
+    """Run a query and return plain tuples, skipping sqlite3.Row for small lookups."""
+    cursor = get_db_connection().cursor()
+    # Only this cursor is affected; the connection keeps sqlite3.Row for everything else
+    cursor.row_factory = None
+    cursor.execute(sql, params)
+    return cursor.fetchall()
+
+@contextmanager
+def transaction():
+    """Run the enclosed statements as one write transaction, rolling back on error."""
+    conn = get_db_connection()
+    # Take the write lock up front so the transaction can't fail to upgrade later
+    conn.execute('BEGIN IMMEDIATE')
+    try:
+        yield conn.cursor()
+        conn.execute('COMMIT')
+    except BaseException:
+        # SQLite may already have rolled back, and a failed COMMIT must not
+        # leave this thread's connection inside the transaction
+        if conn.in_transaction:
+            conn.execute('ROLLBACK')
+        raise
+
 def init_db():
     """Initialize the database with the required tables."""
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    
+    # Serialize initialization so concurrent first runs don't race
+    with _init_lock:
+        cursor = get_db_connection().cursor()
+        cursor.execute('PRAGMA user_version')
+        if cursor.fetchone()[0] >= SCHEMA_VERSION:
+            _load_user_ids()
+            # Nothing to write unless a predefined user was added to the environment
+            if all(username in _user_ids for username in PREDEFINED_USERS):
+                return
+        
+        conn = get_db_connection()
+        # Tables are rebuilt during migration, which foreign keys would block;
+        # this can only be switched outside a transaction
+        conn.execute('PRAGMA foreign_keys = OFF')
+        try:
+            with transaction() as cursor:
+                cursor.execute("SELECT 1 FROM pragma_table_info('inventory') WHERE name = 'id'")
+                if cursor.fetchone():
+                    _migrate_to_product_keys(cursor)
+                # Rebuild the history index if it lacks the id tie-breaker
+                cursor.execute("SELECT 1 FROM pragma_index_info('idx_history_user_date') WHERE name = 'id'")
+                if not cursor.fetchone():
+                    cursor.execute('DROP INDEX IF EXISTS idx_history_user_date')
+                _create_tables(cursor)
+                _convert_timestamps(cursor)
+                # Gather statistics so the planner knows which indexes pay off
+                cursor.execute('ANALYZE')
+
+                cursor.execute('PRAGMA foreign_key_check')
+                if cursor.fetchone():
+                    raise sqlite3.IntegrityError("Foreign key violations after schema update")
+
+                # PRAGMA statements can't take parameters
+                cursor.execute(f'PRAGMA user_version = {SCHEMA_VERSION}')
+                _load_user_ids()
+        finally:
+            conn.execute('PRAGMA foreign_keys = ON')
+
+def _count_history_writes(count=1):
+    """Count usage history writes, refreshing its statistics in the background every ANALYZE_EVERY rows."""
+    global _history_writes
+    with _history_writes_lock:
+        _history_writes += count
+        if _history_writes < ANALYZE_EVERY:
+            return
+        _history_writes = 0
+    threading.Thread(target=_analyze_history, name="analyze-history", daemon=True).start()
+
+def _analyze_history():
+    """Refresh the planner statistics of the usage history table on a separate connection."""
+    conn = sqlite3.connect(DB_PATH)
+    try:
+        conn.execute('ANALYZE product_usage_history')
+    except Exception as e:
+        print(f"Error analyzing usage history: {str(e)}")
+    finally:
+        conn.close()
+
+def _load_user_ids():
+    """Load the user IDs so logins don't need a query."""
+    _user_ids.update((username, user_id) for user_id, username in fetch_tuples('SELECT id, username FROM users'))
+
+def _migrate_to_product_keys(cursor):
+    """Rebuild inventory and history from rowid product IDs to user, name and category keys."""
+    cursor.execute(SQL_CREATE_INVENTORY.format(table='inventory_new'))
+    cursor.execute('''
+        INSERT INTO inventory_new (user_id, product_name, category, quantity, unit,
+                                   date_added, last_used, image_path, min_stock_level)
+        SELECT user_id, product_name, category, quantity, unit,
+               date_added, last_used, image_path, min_stock_level
+        FROM inventory
+    ''')
+
+    # History of products that no longer exist is dropped by the join
+    cursor.execute(SQL_CREATE_HISTORY.format(table='product_usage_history_new'))
+    cursor.execute('''
+        INSERT INTO product_usage_history_new (id, user_id, product_name, category,
+                                               quantity_used, usage_date, operation_type)
+        SELECT h.id, h.user_id, i.product_name, i.category,
+               h.quantity_used, h.usage_date, h.operation_type
+        FROM product_usage_history h
+        JOIN inventory i ON h.product_id = i.id
+    ''')
+
+    cursor.execute('DROP TABLE product_usage_history')
+    cursor.execute('DROP TABLE inventory')
+    cursor.execute('ALTER TABLE inventory_new RENAME TO inventory')
+    cursor.execute('ALTER TABLE product_usage_history_new RENAME TO product_usage_history')
+
+def _convert_timestamps(cursor):
+    """Convert timestamps stored as ISO 8601 text to Unix seconds."""
+    for table, column in (('inventory', 'date_added'), ('inventory', 'last_used'),
+                          ('product_usage_history', 'usage_date')):
+        cursor.execute(f'''
+            UPDATE {table}
+            SET {column} = CAST(strftime('%s', {column}) AS INTEGER)
+            WHERE typeof({column}) = 'text'
+        ''')
+
+def _create_tables(cursor):
+    """Create the tables and predefined users if they don't exist."""
+
     # Create users table
     cursor.execute('''
         CREATE TABLE IF NOT EXISTS users (
@@ -35,45 +295,43 @@ def init_db():
     ''')
     
     # Create inventory table
+    cursor.execute(SQL_CREATE_INVENTORY.format(table='inventory'))
+
+    # Create product usage history table
+    cursor.execute(SQL_CREATE_HISTORY.format(table='product_usage_history'))
+
+    # Partial index holding only the products at or below their minimum stock
     cursor.execute('''
-        CREATE TABLE IF NOT EXISTS inventory (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            user_id INTEGER NOT NULL,
-            product_name TEXT NOT NULL,
-            category TEXT NOT NULL,
-            quantity REAL NOT NULL,
-            unit TEXT NOT NULL,
-            date_added TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-            last_used TIMESTAMP,
-            image_path TEXT,
-            min_stock_level REAL,
-            FOREIGN KEY (user_id) REFERENCES users (id)
-        )
+        CREATE INDEX IF NOT EXISTS idx_inv_user_lowstock
+        ON inventory (user_id) WHERE quantity <= min_stock_level
     ''')
-    
-    # Create product usage history table
+
+    # Usage history is read newest first per user, and per product for the
+    # product page and the cascades from inventory; timestamps are whole
+    # seconds, so the id orders rows written within the same second
     cursor.execute('''
-        CREATE TABLE IF NOT EXISTS product_usage_history (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            user_id INTEGER NOT NULL,
-            product_id INTEGER NOT NULL,
-            quantity_used REAL NOT NULL,
-            usage_date TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-            operation_type TEXT NOT NULL,  -- 'add' or 'remove'
-            FOREIGN KEY (user_id) REFERENCES users (id),
-            FOREIGN KEY (product_id) REFERENCES inventory (id)
-        )
+        CREATE INDEX IF NOT EXISTS idx_history_user_date
+        ON product_usage_history (user_id, usage_date DESC, id DESC)
     ''')
-    
+    cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_history_product
+        ON product_usage_history (user_id, product_name, category)
+    ''')
+
+    # OpenAI image analyses keyed by a hash of the Vision API results
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS openai_cache (
+            prompt_hash TEXT PRIMARY KEY,
+            result_json TEXT NOT NULL
+        ) WITHOUT ROWID
+    ''')
+
     # Insert predefined users if they don't exist
     for username, password in PREDEFINED_USERS.items():
         cursor.execute('''
             INSERT OR IGNORE INTO users (username, password)
             VALUES (?, ?)
         ''', (username, password))
-    
-    conn.commit()
-    conn.close()
 
 def add_user(username, password):
     """Add a new user to the database."""
@@ -82,84 +340,105 @@ def add_user(username, password):
     try:
         cursor.execute('INSERT INTO users (username, password) VALUES (?, ?)', 
                       (username, password))
-        conn.commit()
+        _user_ids[username] = cursor.lastrowid
         return True
     except sqlite3.IntegrityError:
         return False
-    finally:
-        conn.close()
 
 def authenticate_user(username, password):
     """Authenticate a user against predefined users."""
     if username in PREDEFINED_USERS and PREDEFINED_USERS[username] == password:
-        conn = get_db_connection()
-        cursor = conn.cursor()
-        cursor.execute('SELECT id FROM users WHERE username = ?', (username,))
-        user = cursor.fetchone()
-        conn.close()
-        return user['id'] if user else None
+        if username not in _user_ids:
+            user = fetch_tuples(SQL_GET_USER_ID, (username,))
+            if not user:
+                return None
+            _user_ids[username] = user[0][0]
+        return _user_ids[username]
     return None
 
 def add_product(user_id, name, category, quantity, unit, image_path, min_stock_level):
     """Add a new product to the inventory or update existing one."""
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    current_time = datetime.now(pytz.UTC)
+    current_time = int(time.time())
     
-    try:
-        # Check if product already exists
+    with transaction() as cursor:
+        # Insert the product, or add to the quantity of the existing one
         cursor.execute('''
-            SELECT id, quantity FROM inventory 
-            WHERE user_id = ? AND product_name = ? AND category = ?
-        ''', (user_id, name, category))
-        existing_product = cursor.fetchone()
+            INSERT INTO inventory (user_id, product_name, category, quantity, unit, 
+                                 date_added, image_path, min_stock_level)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+            ON CONFLICT (user_id, product_name, category) DO UPDATE
+            SET quantity = inventory.quantity + excluded.quantity, date_added = excluded.date_added
+        ''', (user_id, name, category, quantity, unit, current_time, image_path, min_stock_level))
+
+        # Record usage history
+        cursor.execute(SQL_INSERT_HISTORY, (user_id, name, category, quantity, current_time, 'add'))
+
+    _count_history_writes()
+    return True
+
+def upsert_product(user_id, name, category, unit, quantity, mode='set', image_path=None, min_stock_level=0):
+    """Insert a product or update it in place with a single statement.
+    
+    With mode 'set' an existing product's quantity is replaced; with mode 'add'
+    the quantity is added to it and recorded in the usage history.
+    """
+    if mode == 'set':
+        update_fields = "quantity = excluded.quantity, last_used = excluded.date_added"
+    elif mode == 'add':
+        update_fields = "quantity = inventory.quantity + excluded.quantity, date_added = excluded.date_added"
+    else:
+        raise ValueError(f"Unknown upsert mode: {mode}")
+    
+    try:
+        # Get current time in UTC
+        current_time = int(time.time())
         
-        if existing_product:
-            # Update existing product
-            new_quantity = existing_product['quantity'] + quantity
-            cursor.execute('''
-                UPDATE inventory 
-                SET quantity = ?, date_added = ?
-                WHERE id = ?
-            ''', (new_quantity, current_time, existing_product['id']))
-            
-            # Record usage history
-            cursor.execute('''
-                INSERT INTO product_usage_history 
-                (user_id, product_id, quantity_used, usage_date, operation_type)
-                VALUES (?, ?, ?, ?, ?)
-            ''', (user_id, existing_product['id'], quantity, current_time, 'add'))
-            
-        else:
-            # Add new product
-            cursor.execute('''
+        with transaction() as cursor:
+            cursor.execute(
+                f"""
                 INSERT INTO inventory (user_id, product_name, category, quantity, unit, 
                                      date_added, image_path, min_stock_level)
                 VALUES (?, ?, ?, ?, ?, ?, ?, ?)
-            ''', (user_id, name, category, quantity, unit, current_time, image_path, min_stock_level))
-            
-            # Get the new product ID
-            product_id = cursor.lastrowid
-            
-            # Record usage history
-            cursor.execute('''
-                INSERT INTO product_usage_history 
-                (user_id, product_id, quantity_used, usage_date, operation_type)
-                VALUES (?, ?, ?, ?, ?)
-            ''', (user_id, product_id, quantity, current_time, 'add'))
-        
-        conn.commit()
+                ON CONFLICT (user_id, product_name, category) DO UPDATE
+                SET {update_fields}, unit = excluded.unit,
+                    image_path = COALESCE(excluded.image_path, inventory.image_path)
+                """,
+                (user_id, name, category, quantity, unit, current_time, image_path, min_stock_level)
+            )
+
+            if mode == 'add':
+                # Record usage history
+                cursor.execute(SQL_INSERT_HISTORY, (user_id, name, category, quantity, current_time, 'add'))
+
+        if mode == 'add':
+            _count_history_writes()
         return True
-    finally:
-        conn.close()
+    except Exception as e:
+        print(f"Error saving product: {str(e)}")
+        return False
+
+def clear_image_path(user_id, name, category, image_path):
+    """Drop a product's image path if it still points at the given file."""
+    try:
+        cursor = get_db_connection().cursor()
+        cursor.execute(
+            """
+            UPDATE inventory SET image_path = NULL
+            WHERE user_id = ? AND product_name = ? AND category = ? AND image_path = ?
+            """,
+            (user_id, name, category, image_path)
+        )
+        return cursor.rowcount > 0
+    except Exception as e:
+        print(f"Error clearing image path: {str(e)}")
+        return False
 
 def get_user_inventory(user_id):
     """Get all inventory items for a user."""
     conn = get_db_connection()
     cursor = conn.cursor()
-    cursor.execute('SELECT * FROM inventory WHERE user_id = ?', (user_id,))
+    cursor.execute(SQL_GET_INVENTORY, (user_id,))
     items = cursor.fetchall()
-    conn.close()
     return items
 
 def update_inventory_quantity(user_id, product_name, quantity, min_stock_level=None):
@@ -169,7 +448,7 @@ def update_inventory_quantity(user_id, product_name, quantity, min_stock_level=N
     
     try:
         # Get current time in UTC
-        current_time = datetime.now(pytz.UTC)
+        current_time = int(time.time())
         
         # Prepare the update query
         update_fields = ["quantity = ?", "last_used = ?"]
@@ -192,88 +471,90 @@ def update_inventory_quantity(user_id, product_name, quantity, min_stock_level=N
             update_values
         )
         
-        conn.commit()
         return True
     except Exception as e:
         print(f"Error updating inventory: {str(e)}")
         return False
-    finally:
-        conn.close()
+
+def bulk_update_inventory(user_id, rows):
+    """Update quantity and minimum stock level of several products in one transaction"""
+    try:
+        # Get current time in UTC
+        current_time = int(time.time())
+        
+        with transaction() as cursor:
+            cursor.executemany(
+                """
+                UPDATE inventory 
+                SET quantity = ?, min_stock_level = ?, last_used = ?
+                WHERE user_id = ? AND product_name = ?
+                """,
+                [
+                    (row['quantity'], row['min_stock_level'], current_time, user_id, row['product_name'])
+                    for row in rows
+                ]
+            )
+        
+        return True
+    except Exception as e:
+        print(f"Error updating inventory: {str(e)}")
+        return False
 
 def get_low_stock_items(user_id):
     """Get items that are below their minimum stock level."""
     conn = get_db_connection()
     cursor = conn.cursor()
-    cursor.execute('''
-        SELECT * FROM inventory 
-        WHERE user_id = ? AND quantity <= min_stock_level
-    ''', (user_id,))
+    cursor.execute(SQL_GET_LOW_STOCK, (user_id,))
     items = cursor.fetchall()
-    conn.close()
     return items
 
 def delete_product(user_id, product_name):
     """Delete a product from the inventory."""
     conn = get_db_connection()
     cursor = conn.cursor()
-    
-    try:
-        # First, get the product ID
-        cursor.execute('''
-            SELECT id FROM inventory 
-            WHERE user_id = ? AND product_name = ?
-        ''', (user_id, product_name))
-        product = cursor.fetchone()
-        
-        if product:
-            # Delete from inventory
-            cursor.execute('''
-                DELETE FROM inventory 
-                WHERE user_id = ? AND product_name = ?
-            ''', (user_id, product_name))
-            
-            # Delete associated usage history
-            cursor.execute('''
-                DELETE FROM product_usage_history 
-                WHERE user_id = ? AND product_id = ?
-            ''', (user_id, product['id']))
-            
-            conn.commit()
-            return True
-        return False
-    finally:
-        conn.close()
+
+    # Usage history is removed with it by the ON DELETE CASCADE
+    cursor.execute('''
+        DELETE FROM inventory
+        WHERE user_id = ? AND product_name = ?
+    ''', (user_id, product_name))
+
+    return cursor.rowcount > 0
 
 def get_product_usage_history(user_id, product_name=None, limit=5):
     """Get product usage history."""
     conn = get_db_connection()
     cursor = conn.cursor()
     
+    if product_name:
+        # Get history for specific product
+        cursor.execute(SQL_GET_PRODUCT_HISTORY, (user_id, product_name, limit))
+    else:
+        # Get all recent history
+        cursor.execute(SQL_GET_HISTORY, (user_id, limit))
+
+    return cursor.fetchall()
+
+def get_cached_analysis(prompt_hash):
+    """Get a stored OpenAI analysis, or None if there isn't one."""
     try:
-        if product_name:
-            # Get history for specific product
-            cursor.execute('''
-                SELECT h.*, i.product_name 
-                FROM product_usage_history h
-                JOIN inventory i ON h.product_id = i.id
-                WHERE h.user_id = ? AND i.product_name = ?
-                ORDER BY h.usage_date DESC
-                LIMIT ?
-            ''', (user_id, product_name, limit))
-        else:
-            # Get all recent history
-            cursor.execute('''
-                SELECT h.*, i.product_name 
-                FROM product_usage_history h
-                JOIN inventory i ON h.product_id = i.id
-                WHERE h.user_id = ?
-                ORDER BY h.usage_date DESC
-                LIMIT ?
-            ''', (user_id, limit))
-        
-        return cursor.fetchall()
-    finally:
-        conn.close()
+        rows = fetch_tuples('SELECT result_json FROM openai_cache WHERE prompt_hash = ?', (prompt_hash,))
+        return rows[0][0] if rows else None
+    except Exception as e:
+        print(f"Error reading analysis cache: {str(e)}")
+        return None
 
-# Initialize the database when the module is imported
-init_db() 
\ No newline at end of file
+def save_cached_analysis(prompt_hash, result_json):
+    """Store an OpenAI analysis for reuse."""
+    try:
+        conn = get_db_connection()
+        cursor = conn.cursor()
+        cursor.execute('''
+            INSERT OR REPLACE INTO openai_cache (prompt_hash, result_json)
+            VALUES (?, ?)
+        ''', (prompt_hash, result_json))
+        return True
+    except Exception as e:
+        print(f"Error saving analysis cache: {str(e)}")
+        return False
+ 
\ No newline at end of file
@@ -0,0 +1,137 @@
+import asyncio
+import os
+import random
+import threading
+import time
+import openai
+from dotenv import load_dotenv
+
+# Load environment variables
+load_dotenv()
+
+# Limits shared by every OpenAI request made by this process
+MAX_CONCURRENCY = int(os.getenv('OPENAI_MAX_CONCURRENCY', '8'))
+REQUESTS_PER_MINUTE = float(os.getenv('OPENAI_RPM_LIMIT', '3500'))
+TOKENS_PER_MINUTE = float(os.getenv('OPENAI_TPM_LIMIT', '90000'))
+MAX_ATTEMPTS = 3
+
+# Errors worth retrying: 429 rate limits, 5xx server errors, and connection
+# errors and timeouts, which the clients no longer retry themselves
+RETRYABLE_ERRORS = (openai.RateLimitError, openai.InternalServerError, openai.APIConnectionError)
+
+class RateLimiter:
+    """Token-bucket limiter tracking requests and tokens per minute"""
+
+    def __init__(self, requests_per_minute, tokens_per_minute):
+        self.requests_per_minute = requests_per_minute
+        self.tokens_per_minute = tokens_per_minute
+        self.available_requests = requests_per_minute
+        self.available_tokens = tokens_per_minute
+        self.last_update = time.monotonic()
+        self.lock = asyncio.Lock()
+
+    def _refill(self):
+        """Add the capacity recovered since the last update"""
+        now = time.monotonic()
+        elapsed = now - self.last_update
+        self.available_requests = min(
+            self.requests_per_minute,
+            self.available_requests + elapsed * self.requests_per_minute / 60
+        )
+        self.available_tokens = min(
+            self.tokens_per_minute,
+            self.available_tokens + elapsed * self.tokens_per_minute / 60
+        )
+        self.last_update = now
+
+    async def acquire(self, tokens):
+        """Wait until one request and the given number of tokens are available"""
+        tokens = min(tokens, self.tokens_per_minute)
+        async with self.lock:
+            while True:
+                self._refill()
+                if self.available_requests >= 1 and self.available_tokens >= tokens:
+                    self.available_requests -= 1
+                    self.available_tokens -= tokens
+                    return
+                wait = max(
+                    (1 - self.available_requests) * 60 / self.requests_per_minute,
+                    (tokens - self.available_tokens) * 60 / self.tokens_per_minute
+                )
+                await asyncio.sleep(wait)
+
+# All requests run on one long-lived event loop so the semaphore, the limiter
+# and the clients' connection pools are shared across Streamlit sessions
+_loop = asyncio.new_event_loop()
+_thread = threading.Thread(target=_loop.run_forever, name="openai-pool", daemon=True)
+_thread.start()
+
+_semaphore = asyncio.Semaphore(MAX_CONCURRENCY)
+_limiter = RateLimiter(REQUESTS_PER_MINUTE, TOKENS_PER_MINUTE)
+
+def run(coro):
+    """Run a coroutine on the shared event loop and wait for its result"""
+    return asyncio.run_coroutine_threadsafe(coro, _loop).result()
+
+async def _next(agen):
+    """Get the next item of an async generator, flagging when it is exhausted"""
+    try:
+        return False, await agen.__anext__()
+    except StopAsyncIteration:
+        return True, None
+
+def iterate(agen):
+    """Iterate an async generator on the shared event loop from synchronous code"""
+    try:
+        while True:
+            done, item = run(_next(agen))
+            if done:
+                return
+            yield item
+    finally:
+        closing = asyncio.run_coroutine_threadsafe(agen.aclose(), _loop)
+        # Garbage collection may finalize this generator on the loop thread,
+        # which must not wait on itself
+        if threading.current_thread() is not _thread:
+            closing.result()
+
+def estimate_tokens(request):
+    """Roughly estimate the tokens a chat completion request will consume"""
+    prompt_chars = sum(len(message.get('content') or '') for message in request.get('messages', []))
+    completion_tokens = request.get('max_tokens') or 1000
+    return prompt_chars // 4 + completion_tokens * request.get('n', 1)
+
+async def chat_completion(client, **request):
+    """Create a chat completion within the shared limits, retrying transient errors"""
+    tokens = estimate_tokens(request)
+    for attempt in range(1, MAX_ATTEMPTS + 1):
+        try:
+            async with _semaphore:
+                await _limiter.acquire(tokens)
+                return await client.chat.completions.create(**request)
+        except RETRYABLE_ERRORS:
+            if attempt == MAX_ATTEMPTS:
+                raise
+            # Exponential backoff with jitter, outside the semaphore
+            await asyncio.sleep(2 ** attempt + random.uniform(0, 1))
+
+async def chat_completion_stream(client, **request):
+    """Stream the text of a chat completion within the shared limits, retrying transient errors"""
+    tokens = estimate_tokens(request)
+    for attempt in range(1, MAX_ATTEMPTS + 1):
+        started = False
+        try:
+            async with _semaphore:
+                await _limiter.acquire(tokens)
+                stream = await client.chat.completions.create(stream=True, **request)
+                async for chunk in stream:
+                    if chunk.choices and chunk.choices[0].delta.content:
+                        started = True
+                        yield chunk.choices[0].delta.content
+                return
+        except RETRYABLE_ERRORS:
+            # Text already shown to the user cannot be taken back
+            if started or attempt == MAX_ATTEMPTS:
+                raise
+            # Exponential backoff with jitter, outside the semaphore
+            await asyncio.sleep(2 ** attempt + random.uniform(0, 1))
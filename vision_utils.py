@@ -2,23 +2,54 @@ from google.cloud import vision
 import os
 from PIL import Image
 import io
-import tempfile
 import json
-import re
+import threading
+import hashlib
+import functools
+import concurrent.futures
+from pathlib import Path
 from dotenv import load_dotenv
-import openai
+from openai import AsyncOpenAI
 from google.oauth2 import service_account
+from database import get_cached_analysis, save_cached_analysis
+from openai_pool import run, chat_completion
 
 # Load environment variables
 load_dotenv()
 
-# Initialize OpenAI
-openai.api_key = os.getenv("OPENAI_API_KEY")
+# Initialize OpenAI; requests go through openai_pool, which handles limits and retries
+openai_client = AsyncOpenAI(api_key=os.getenv("OPENAI_API_KEY"), max_retries=0)
+
+# Vision API client shared by every thread, created on first use
+_vision_client = None
+_vision_client_lock = threading.Lock()
+
+# Largest image sent to the Vision API; its models work on smaller inputs anyway
+VISION_MAX_SIZE = (1600, 1600)
+
+# Per-thread buffer reused for every JPEG encode
+_buffers = threading.local()
+
+# Most images the Vision API accepts in one batch request
+VISION_BATCH_SIZE = 16
+
+# OpenAI analyses run at once when processing several images
+OPENAI_WORKERS = 8
+
+# Detections requested together for product images
+ALL_FEATURES = (
+    vision.Feature.Type.LABEL_DETECTION,
+    vision.Feature.Type.TEXT_DETECTION,
+    vision.Feature.Type.OBJECT_LOCALIZATION
+)
+
+# Translation table deleting C0 and C1 control characters
+_CONTROL_CHARS = dict.fromkeys([*range(0x20), *range(0x7f, 0xa0)])
 
 def clean_json_string(s):
     """Clean JSON string by removing control characters and properly escaping newlines"""
     # Remove control characters
-    s = re.sub(r'[\x00-\x1f\x7f-\x9f]', '', s)
+    s = s.translate(_CONTROL_CHARS)
     # Properly escape newlines in private key
     s = s.replace('\\n', '\\\\n')
     # Remove any extra whitespace
@@ -53,6 +84,79 @@ def get_vision_client():
     except Exception as e:
         raise Exception(f"Failed to initialize Vision API client: {str(e)}")
 
+def _client():
+    """Get the shared Vision API client, creating it on first use"""
+    global _vision_client
+    if _vision_client is None:
+        # Image analysis runs on several threads; only one may build the client
+        with _vision_client_lock:
+            if _vision_client is None:
+                _vision_client = get_vision_client()
+    return _vision_client
+
+def _annotate(content, features):
+    """Run several Vision API detections on image bytes in a single request"""
+    return _client().annotate_image({
+        'image': vision.Image(content=content),
+        'features': [{'type_': feature} for feature in features]
+    })
+
+def _request_analysis(vision_results):
+    """Ask OpenAI to analyze vision results, raising if the reply isn't valid JSON"""
+    # Prepare the prompt with vision results
+    prompt = f"""Vision API Results:
+- Labels: {', '.join(vision_results.get('labels', []))}
+- Detected Text: {', '.join(vision_results.get('texts', []))}
+- Objects: {', '.join(vision_results.get('objects', []))}
+
+Reply with a JSON object of this form:
+{{"product_name": "specific product name", "category": "best category, new ones allowed", "unit": "kg|g|L|ml|pcs|box|pack", "quantity": 1.0, "notes": "short description"}}"""
+
+    # Call OpenAI API; JSON mode guarantees a parseable object
+    response = run(chat_completion(
+        openai_client,
+        model="gpt-3.5-turbo",
+        messages=[
+            {"role": "system", "content": "You are an expert in product identification and inventory management. Identify the product from image detection results."},
+            {"role": "user", "content": prompt}
+        ],
+        response_format={"type": "json_object"},
+        temperature=0.3,
+        max_tokens=400
+    ))
+
+    # Parse the response
+    result = json.loads(response.choices[0].message.content)
+
+    # Validate required fields
+    required_fields = ['product_name', 'category', 'unit', 'quantity', 'notes']
+    for field in required_fields:
+        if field not in result:
+            result[field] = "Unknown" if field != 'quantity' else 1.0
+
+    # Validate unit
+    valid_units = ['kg', 'g', 'L', 'ml', 'pcs', 'box', 'pack']
+    if result['unit'] not in valid_units:
+        result['unit'] = 'pcs'
+
+    # Ensure quantity is a number
+    try:
+        result['quantity'] = float(result['quantity'])
+    except (ValueError, TypeError):
+        result['quantity'] = 1.0
+
+    return result
+
+@functools.lru_cache(maxsize=512)
+def _cached_analysis(prompt_hash, vision_json):
+    """Get the analysis of serialized vision results as JSON, from the database when seen before"""
+    result_json = get_cached_analysis(prompt_hash)
+    if result_json is None:
+        # Failures raise, so they are never cached
+        result_json = json.dumps(_request_analysis(json.loads(vision_json)))
+        save_cached_analysis(prompt_hash, result_json)
+    return result_json
+
 def analyze_with_openai(vision_results):
     """Use OpenAI to analyze and enhance the vision results"""
     try:
@@ -65,69 +169,21 @@ def analyze_with_openai(vision_results):
                 "notes": "No vision results available"
             }
 
-        # Prepare the prompt with vision results
-        prompt = f"""You are an expert in product identification and inventory management. 
-Analyze the following product image detection results and provide detailed information:
-
-Vision API Results:
-- Labels: {', '.join(vision_results.get('labels', []))}
-- Detected Text: {', '.join(vision_results.get('texts', []))}
-- Objects: {', '.join(vision_results.get('objects', []))}
-
-Please provide a detailed analysis including:
-1. Product Name: [specific and accurate name]
-2. Category: [suggest the most appropriate category, you can create new categories if needed]
-3. Unit: [must be one of: kg, g, L, ml, pcs, box, pack]
-4. Quantity: [estimated typical quantity as a number]
-5. Detailed Analysis: [comprehensive description of the product]
+        # Identical vision results get the same analysis without another request
+        vision_json = json.dumps(vision_results, sort_keys=True)
+        prompt_hash = hashlib.blake2b(vision_json.encode(), digest_size=16).hexdigest()
+        return json.loads(_cached_analysis(prompt_hash, vision_json))
 
-Format your response as a JSON object with these exact keys: product_name, category, unit, quantity, notes.
-The unit must match exactly with the options provided above."""
+    except json.JSONDecodeError:
+        # If JSON parsing fails, return a structured response
+        return {
+            "product_name": vision_results.get('labels', ['Unknown Product'])[0],
+            "category": "Grocery",
+            "unit": "pcs",
+            "quantity": 1.0,
+            "notes": "Could not parse detailed analysis"
+        }
 
-        # Call OpenAI API
-        response = openai.ChatCompletion.create(
-            model="gpt-3.5-turbo",
-            messages=[
-                {"role": "system", "content": "You are an expert in product identification and inventory management. Provide accurate and detailed analysis."},
-                {"role": "user", "content": prompt}
-            ],
-            temperature=0.3,
-            max_tokens=1000
-        )
-        
-        # Parse the response
-        try:
-            result = json.loads(response.choices[0].message.content)
-            
-            # Validate required fields
-            required_fields = ['product_name', 'category', 'unit', 'quantity', 'notes']
-            for field in required_fields:
-                if field not in result:
-                    result[field] = "Unknown" if field != 'quantity' else 1.0
-            
-            # Validate unit
-            valid_units = ['kg', 'g', 'L', 'ml', 'pcs', 'box', 'pack']
-            if result['unit'] not in valid_units:
-                result['unit'] = 'pcs'
-            
-            # Ensure quantity is a number
-            try:
-                result['quantity'] = float(result['quantity'])
-            except (ValueError, TypeError):
-                result['quantity'] = 1.0
-            
-            return result
-            
-        except json.JSONDecodeError:
-            # If JSON parsing fails, return a structured response
-            return {
-                "product_name": vision_results.get('labels', ['Unknown Product'])[0],
-                "category": "Grocery",
-                "unit": "pcs",
-                "quantity": 1.0,
-                "notes": "Could not parse detailed analysis"
-            }
-            
     except Exception as e:
         print(f"Error in OpenAI analysis: {str(e)}")
         # Return a default response if OpenAI analysis fails
@@ -139,143 +195,168 @@ The unit must match exactly with the options provided above."""
             "notes": f"Error in analysis: {str(e)}"
         }
 
-def process_product_image(image):
+def _image_content(image, content=None):
+    """Get JPEG bytes of an image for the Vision API, downscaled to VISION_MAX_SIZE
+
+    content is the image's original file, sent unchanged when it is
+    already an RGB JPEG within the size limit.
+    """
+    if (content is not None and image.format == 'JPEG' and image.mode == 'RGB'
+            and image.width <= VISION_MAX_SIZE[0] and image.height <= VISION_MAX_SIZE[1]):
+        return content
+
+    # Shrink an RGB copy for upload, keeping the original for display
+    vision_image = image.convert('RGB') if image.mode != 'RGB' else image.copy()
+    vision_image.thumbnail(VISION_MAX_SIZE, Image.Resampling.LANCZOS)
+
+    # Convert PIL Image to bytes, reusing this thread's buffer
+    buffer = getattr(_buffers, 'buffer', None)
+    if buffer is None:
+        buffer = _buffers.buffer = io.BytesIO()
+    buffer.seek(0)
+    buffer.truncate()
+    vision_image.save(buffer, format='JPEG', quality=85, optimize=True)
+    return buffer.getvalue()
+
+def _vision_results(response):
+    """Get the label, text and object descriptions from a Vision API response"""
+    return {
+        'labels': [label.description for label in response.label_annotations],
+        'texts': [text.description for text in response.text_annotations],
+        'objects': [obj.name for obj in response.localized_object_annotations]
+    }
+
+def process_product_image(image, content=None):
     """Process product image using Google Cloud Vision API and OpenAI"""
     try:
-        # Convert PIL Image to bytes
-        img_byte_arr = io.BytesIO()
-        image.save(img_byte_arr, format='JPEG')
-        img_byte_arr = img_byte_arr.getvalue()
-        
-        # Create Vision API image object
-        vision_image = vision.Image(content=img_byte_arr)
-        
-        # Get the client
-        client = get_vision_client()
-        
         # Perform detections
-        response = client.annotate_image({
-            'image': vision_image,
-            'features': [
-                {'type_': vision.Feature.Type.LABEL_DETECTION},
-                {'type_': vision.Feature.Type.TEXT_DETECTION},
-                {'type_': vision.Feature.Type.OBJECT_LOCALIZATION}
-            ]
-        })
-        
+        response = _annotate(_image_content(image, content), ALL_FEATURES)
+        if response.error.message:
+            raise Exception(response.error.message)
+
         # Process results
-        vision_results = {
-            'labels': [label.description for label in response.label_annotations],
-            'texts': [text.description for text in response.text_annotations],
-            'objects': [obj.name for obj in response.localized_object_annotations]
-        }
-        
+        vision_results = _vision_results(response)
+
         # Enhance with OpenAI
         enhanced_results = analyze_with_openai(vision_results)
-        
+
         return {
             'vision_results': vision_results,
             'enhanced_results': enhanced_results
         }
-        
+
     except Exception as e:
         print(f"Error processing image: {str(e)}")
         raise Exception(f"Could not analyze the image: {str(e)}")
 
-def detect_labels(image_path):
-    """Detect labels in an image using Google Cloud Vision API"""
-    client = vision.ImageAnnotatorClient()
-    
-    with open(image_path, 'rb') as image_file:
-        content = image_file.read()
-    
-    image = vision.Image(content=content)
-    response = client.label_detection(image=image)
-    labels = response.label_annotations
-    
-    # Sort labels by confidence score
-    sorted_labels = sorted(labels, key=lambda x: x.score, reverse=True)
-    return [label.description for label in sorted_labels]
+def _batch_result(response):
+    """Analyze one image's Vision API response from a batch, marking it if the detections failed"""
+    if response.error.message:
+        return {
+            'vision_results': None,
+            'enhanced_results': None,
+            'error': response.error.message
+        }
 
-def detect_text(image_path):
-    """Detect text in an image using Google Cloud Vision API"""
-    client = vision.ImageAnnotatorClient()
-    
-    with open(image_path, 'rb') as image_file:
-        content = image_file.read()
-    
-    image = vision.Image(content=content)
-    response = client.text_detection(image=image)
+    vision_results = _vision_results(response)
+    return {
+        'vision_results': vision_results,
+        'enhanced_results': analyze_with_openai(vision_results),
+        'error': None
+    }
+
+def process_product_images(images):
+    """Process several product images with batched Vision API requests and concurrent OpenAI calls"""
+    try:
+        features = [{'type_': feature} for feature in ALL_FEATURES]
+        requests = [
+            {'image': vision.Image(content=_image_content(image)), 'features': features}
+            for image in images
+        ]
+
+        # Perform detections, as few requests as the batch limit allows
+        responses = []
+        for start in range(0, len(requests), VISION_BATCH_SIZE):
+            response = _client().batch_annotate_images(requests=requests[start:start + VISION_BATCH_SIZE])
+            responses.extend(response.responses)
+
+        # Enhance with OpenAI, one request per image in parallel within openai_pool's limits;
+        # images the Vision API failed on keep their error instead
+        with concurrent.futures.ThreadPoolExecutor(max_workers=OPENAI_WORKERS) as executor:
+            return list(executor.map(_batch_result, responses))
+
+    except Exception as e:
+        print(f"Error processing images: {str(e)}")
+        raise Exception(f"Could not analyze the images: {str(e)}")
+
+def _sorted_labels(response):
+    """Get label descriptions sorted by confidence score"""
+    labels = sorted(response.label_annotations, key=lambda x: x.score, reverse=True)
+    return [label.description for label in labels]
+
+def _full_text(response):
+    """Get the full block of detected text"""
     texts = response.text_annotations
-    
     if texts:
         return texts[0].description
     return ""
 
+def _sorted_objects(response):
+    """Get object names sorted by confidence score"""
+    objects = sorted(response.localized_object_annotations, key=lambda x: x.score, reverse=True)
+    return [obj.name for obj in objects]
+
+def detect_labels(image_path):
+    """Detect labels in an image using Google Cloud Vision API"""
+    response = _annotate(Path(image_path).read_bytes(), [vision.Feature.Type.LABEL_DETECTION])
+    return _sorted_labels(response)
+
+def detect_text(image_path):
+    """Detect text in an image using Google Cloud Vision API"""
+    response = _annotate(Path(image_path).read_bytes(), [vision.Feature.Type.TEXT_DETECTION])
+    return _full_text(response)
+
 def detect_objects(image_path):
     """Detect objects in an image using Google Cloud Vision API"""
-    client = vision.ImageAnnotatorClient()
-    
-    with open(image_path, 'rb') as image_file:
-        content = image_file.read()
-    
-    image = vision.Image(content=content)
-    response = client.object_localization(image=image)
-    objects = response.localized_object_annotations
-    
-    # Sort objects by confidence score
-    sorted_objects = sorted(objects, key=lambda x: x.score, reverse=True)
-    return [obj.name for obj in sorted_objects]
+    response = _annotate(Path(image_path).read_bytes(), [vision.Feature.Type.OBJECT_LOCALIZATION])
+    return _sorted_objects(response)
+
+def detect_all(image_path):
+    """Detect labels, text and objects in an image with a single Vision API request"""
+    response = _annotate(Path(image_path).read_bytes(), ALL_FEATURES)
+    return {
+        'labels': _sorted_labels(response),
+        'text': _full_text(response),
+        'objects': _sorted_objects(response)
+    }
 
 def analyze_product_image(image):
     """Analyze product image using both Google Cloud Vision and OpenAI"""
     try:
         # Get Vision API results
-        vision_results = process_product_image(image)
-        
-        # Prepare data for OpenAI analysis
-        vision_data = {
-            'labels': vision_results['labels'],
-            'texts': vision_results['texts'],
-            'objects': vision_results['objects']
-        }
-        
+        vision_data = _vision_results(_annotate(_image_content(image), ALL_FEATURES))
+
         # Create prompt for OpenAI
-        prompt = f"""Analyze this product image data and provide detailed information:
-        
-        Vision API Results:
-        - Labels: {', '.join(vision_data['labels'][:5])}
-        - Detected Text: {', '.join(vision_data['texts'][:3]) if vision_data['texts'] else 'None'}
-        - Objects: {', '.join(vision_data['objects'][:5])}
-        
-        Please provide a detailed analysis of the product, including:
-        1. Product name
-        2. Category
-        3. Key features
-        4. Unit of measurement
-        5. Recommended minimum stock level
-        
-        Format your response as a JSON object with these exact keys:
-        {{
-            "product_name": "string",
-            "category": "string",
-            "unit": "string",
-            "min_stock_level": number,
-            "analysis": "string"
-        }}
-        
-        The "analysis" field should contain your detailed description of the product."""
-        
-        # Get OpenAI analysis
-        response = openai.ChatCompletion.create(
+        prompt = f"""Vision API Results:
+- Labels: {', '.join(vision_data['labels'][:5])}
+- Detected Text: {', '.join(vision_data['texts'][:3]) if vision_data['texts'] else 'None'}
+- Objects: {', '.join(vision_data['objects'][:5])}
+
+Reply with a JSON object of this form:
+{{"product_name": "string", "category": "string", "unit": "string", "min_stock_level": 0, "analysis": "key features of the product"}}"""
+
+        # Get OpenAI analysis; JSON mode guarantees a parseable object
+        response = run(chat_completion(
+            openai_client,
             model="gpt-3.5-turbo",
             messages=[
-                {"role": "system", "content": "You are a product analysis expert. Analyze the given data and provide detailed product information in JSON format."},
+                {"role": "system", "content": "You are a product analysis expert. Analyze the given data and provide product information in JSON format."},
                 {"role": "user", "content": prompt}
             ],
-            max_tokens=500,
+            response_format={"type": "json_object"},
+            max_tokens=400,
             temperature=0.7
-        )
+        ))
         
         # Parse OpenAI response
         try: